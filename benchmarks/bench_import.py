@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+""" Measure the import time of the plugin against a budget.
+
+Every run times the import of the core modules and of the omemo.py adapter
+in a fresh interpreter, with profanity's prof module stubbed out. Exits
+non-zero if the best run of either is over budget or if heavy modules were
+loaded eagerly.
+
+The default budget is the measured best of 40-50 ms plus a 25 ms margin
+for slower machines. Before the core/adapter split omemo.py imported the
+omemo library eagerly, which took about 90 ms.
+
+    python benchmarks/bench_import.py [--budget-ms 75] [--runs 10]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CORE_MODULES = ['prof_omemo.constants', 'prof_omemo.errors',
+                'prof_omemo.stanza', 'prof_omemo.state', 'prof_omemo.crypto']
+
+# the profanity adapter, it needs the prof module
+ADAPTER_MODULES = ['omemo']
+
+# must not be imported before they are used, the python-omemo library is
+# checked by its submodule as the adapter itself is named omemo
+LAZY_MODULES = ['omemo.state', 'axolotl', 'cryptography', 'Crypto',
+                'Cryptodome', 'prof_omemo.transfer', 'http.client', 'httplib']
+
+IMPORT_SCRIPT = '''
+import sys, time, types
+sys.modules['prof'] = types.ModuleType('prof')
+start = time.time()
+{imports}
+elapsed = time.time() - start
+eager = [m for m in {lazy!r} if m in sys.modules]
+print('{{0}} {{1}}'.format(elapsed, ','.join(eager)))
+'''
+
+
+def _run(imports):
+    script = IMPORT_SCRIPT.format(imports=imports, lazy=LAZY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', script],
+                                     cwd=ROOT).decode('ascii').split()
+    return float(output[0]), output[1].split(',') if len(output) > 1 else []
+
+
+def _bench(name, modules, runs, budget_ms):
+    """ Time the import of modules, returns True if within budget and lazy. """
+    imports = '\n'.join('import {0}'.format(m) for m in modules)
+    results = [_run(imports) for _ in range(runs)]
+    best = min(elapsed for elapsed, _ in results) * 1000
+    eager = set(m for _, eager_modules in results for m in eager_modules)
+
+    print('{0} import: best {1:.1f} ms over {2} runs (budget {3:.1f} ms)'
+          .format(name, best, runs, budget_ms))
+
+    passed = True
+    if best > budget_ms:
+        print('FAIL: {0} import time over budget'.format(name))
+        passed = False
+    if eager:
+        print('FAIL: {0} eagerly imported {1}'.format(
+            name, ', '.join(sorted(eager))))
+        passed = False
+
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=75.0)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    passed = _bench('core', CORE_MODULES, args.runs, args.budget_ms)
+    passed &= _bench('adapter', ADAPTER_MODULES, args.runs, args.budget_ms)
+
+    return 0 if passed else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+""" Benchmark the encrypted file transfer against a local HTTP server.
+
+A throwaway HTTP server on localhost stands in for the upload service. The
+benchmark encrypts a generated file into a streamed PUT, downloads and
+decrypts it again and reports the throughput of every step together with
+the peak memory use of the process.
+
+    python benchmarks/bench_transfer.py [--size-mb 256] [--backend NAME]
+"""
+import argparse
+import hashlib
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prof_omemo import crypto, transfer  # noqa: E402
+from prof_omemo.constants import FILE_CHUNK_SIZE  # noqa: E402
+
+
+class _FileServerHandler(BaseHTTPRequestHandler):
+    """ Stores PUT bodies in the server's directory and serves them back. """
+
+    def _path(self):
+        return os.path.join(self.server.root, os.path.basename(self.path))
+
+    def do_PUT(self):
+        remaining = int(self.headers['Content-Length'])
+        with open(self._path(), 'wb') as dst:
+            while remaining:
+                chunk = self.rfile.read(min(FILE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                remaining -= len(chunk)
+        self.send_response(201)
+        self.end_headers()
+
+    def do_GET(self):
+        path = self._path()
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.end_headers()
+        with open(path, 'rb') as src:
+            shutil.copyfileobj(src, self.wfile, FILE_CHUNK_SIZE)
+
+    def log_message(self, *args):
+        pass
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as src:
+        for chunk in iter(lambda: src.read(FILE_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _timed(label, size, fn, *args):
+    start = time.time()
+    result = fn(*args)
+    elapsed = max(time.time() - start, 1e-9)
+    print('{0:<10} {1:8.1f} MiB/s  peak rss {2:.1f} MiB'.format(
+        label, size / elapsed / 1024 / 1024, _peak_rss_mb()))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--backend', default=None,
+                        help='backend name, the fastest one by default')
+    args = parser.parse_args()
+
+    if args.backend:
+        backend_cls = dict((b.name, b) for b in crypto.PAYLOAD_BACKENDS)
+        backend = backend_cls[args.backend]()
+    else:
+        backend, _ = crypto.select_payload_backend()
+    print('backend {0}, file size {1} MiB'.format(backend.name, args.size_mb))
+
+    work_dir = tempfile.mkdtemp(prefix='omemo-bench-')
+    server = HTTPServer(('127.0.0.1', 0), _FileServerHandler)
+    server.root = work_dir
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = 'http://127.0.0.1:{0}/'.format(server.server_port)
+
+    try:
+        src_path = os.path.join(work_dir, 'plain.bin')
+        block = os.urandom(1024 * 1024)
+        with open(src_path, 'wb') as src:
+            for _ in range(args.size_mb):
+                src.write(block)
+        size = args.size_mb * 1024 * 1024
+        print('baseline peak rss {0:.1f} MiB'.format(_peak_rss_mb()))
+
+        key, iv = os.urandom(32), os.urandom(12)
+        status = _timed('upload', size, transfer.upload_file, backend,
+                        base_url + 'cipher.bin', {}, src_path, size, key, iv)
+        assert status == 201, status
+
+        out_path = _timed('download', size, transfer.download_decrypted,
+                          backend, base_url + 'cipher.bin', key, iv,
+                          os.path.join(work_dir, 'downloads'))
+        assert _sha256(out_path) == _sha256(src_path), 'roundtrip mismatch'
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
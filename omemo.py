@@ -1,31 +1,32 @@
 # -*- coding: utf-8 -*-
+""" Profanity adapter of the OMEMO plugin
+
+Wires profanity's hooks and the /omemo command to the prof_omemo core,
+see prof_omemo for the protocol workflow. Only this module depends on
+profanity's prof module.
+"""
 import logging
 import os
-import sys
-import uuid
-from base64 import b64decode
-
-import prof
-
-sys.path.append('/Applications/PyCharm.app/Contents/debug-eggs/pycharm-debug.egg')
+import threading
+import time
 
 try:
-    import sqlite3
+    import queue
 except ImportError:
-    prof.log_error('Could not import sqlite3')
-    raise
+    # python 2
+    import Queue as queue
 
-try:
-    from lxml import etree as ET
-except ImportError:
-    # fallback to the default ElementTree module
-    import xml.etree.ElementTree as ET
+import prof
 
-try:
-    from omemo.state import OmemoState
-except ImportError:
-    prof.cons_show('Could not import OmemoState')
-    raise
+from prof_omemo import stanza as omemo_stanza
+from prof_omemo.constants import (AESGCM_TAG_SIZE, DEVICE_ACTIVE,
+                                  DEVICE_TRUSTED, NS_BUNDLES, NS_DEVICE_LIST,
+                                  NS_DEVICE_LIST_NOTIFY, NS_DISCO_INFO,
+                                  NS_DISCO_ITEMS, NS_HTTP_UPLOAD,
+                                  MAX_DOWNLOAD_MB, UPLOAD_SLOT_TIMEOUT)
+from prof_omemo.errors import DownloadTooLarge
+from prof_omemo.state import ContextRegistry, get_local_data_path
+from prof_omemo.stanza import ET
 
 
 class ProfLogHandler(logging.Handler):
@@ -43,129 +44,35 @@ class ProfLogHandler(logging.Handler):
         }
 
         try:
-            msg = u'{0}: {1}'.format(record.name, record.msg)
+            msg = u'{0}: {1}'.format(record.name, record.getMessage())
             level_fn_map[record.levelno](msg)
         except:
             pass
 
-omemo_logger = logging.getLogger('omemo')
-omemo_logger.setLevel(logging.DEBUG)
-omemo_log_handler = ProfLogHandler()
-omemo_logger.addHandler(omemo_log_handler)
-
-""" Plugin to allow to encrypt/decrypt messages using axolotl
-
-Workflow:
-
-- Init
-    Create Keypair if not existent
-    Create sqlite db if necessary
-    Announce own device to support OMEMO
-
-- Receive Messages
-    - Get devicelist updates and cache them
-    - If a device receives an update  -> check if own device is still announced.
-      If not re-announce
-
-    Furthermore, a device MUST announce it’s IdentityKey, a signed PreKey,
-    and a list of PreKeys in a separate, per-device PEP node.
-    The list SHOULD contain 100 PreKeys, but MUST contain no less than 20.
-
-- Build a Session
-    - fetch their bundle
-
-- Sending a Message
-    In order to send a chat message, its <body> first has to be encrypted.
-    The client MUST use fresh, randomly generated key/IV pairs with AES-128 in
-    Galois/Counter Mode (GCM). For each intended recipient device, i.e. both
-    own devices as well as devices associated with the contact, this key is
-    encrypted using the corresponding long-standing axolotl session.
-    Each encrypted payload key is tagged with the recipient device’s ID.
-    This is all serialized into a MessageElement,
-    which is transmitted in a <message> as follows:
-
-
-- Sending a key
-    The client may wish to transmit keying material to the contact. This
-    first has to be generated. The client MUST generate a fresh, randomly
-    generated key/IV pair. For each intended recipient device, i.e. both own
-    devices as well as devices associated with the contact, this key is
-    encrypted using the corresponding long-standing axolotl session.
-    Each encrypted payload key is tagged with the recipient device’s ID.
-    This is all serialized into a KeyTransportElement,
-    omitting the <payload> as follows:
 
-"""
-HOME = os.path.expanduser("~")
-XDG_DATA_HOME = os.environ.get("XDG_DATA_HOME",
-                               os.path.join(HOME, ".local", "share"))
-
-# OMEMO static namespace vars
-NS_OMEMO = 'eu.siacs.conversations.axolotl'
-NS_DEVICE_LIST = NS_OMEMO + '.devicelist'
-NS_DEVICE_LIST_NOTIFY = NS_DEVICE_LIST + '+notify'
-NS_BUNDLES = NS_OMEMO + '.bundles'
-
-
-__OMEMO_ACCOUNT = None
-__OMEMO_FULLJID = None
-__OMEMO_BUNDLE = None
-__OMEMO_DEVICES = {}
-__OMEMO_STATE = None
-__REQ_INCR = {}
+# account contexts, kept across reconnects and account switches
+__OMEMO_CONTEXTS = ContextRegistry()
+# AES-GCM backend chosen on first connect, the self-benchmark results and
+# whether the omemo library uses the backend for message payloads too
+__PAYLOAD_BACKEND = None
+__PAYLOAD_BENCH = []
+__PAYLOAD_INSTALLED = False
+# callbacks handed from transfer threads to profanity's main loop
+__MAIN_LOOP_QUEUE = queue.Queue()
 
 ################################################################################
 # Convenience methods
 ################################################################################
 
 
-def db():
-    """ Open in memory sqlite db and create a table. """
-    db_path = _get_db_path()
-    db_root = os.path.dirname(db_path)
-    if not os.path.isdir(db_root):
-        os.makedirs(db_root)
-    prof.log_info('Using database path {}'.format(db_path))
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    return conn
-
-
-def _get_local_data_path():
-    current_user = __OMEMO_ACCOUNT
-    safe_username = current_user.replace('@', '_at_')
-
-    return os.path.join(XDG_DATA_HOME, 'profanity', 'omemo', safe_username)
-
-
-def _get_db_path():
-    return os.path.join(_get_local_data_path(), 'omemo.db')
-
-
-def decode_data(data):
-    """ Fetch the data from specified node and b64decode it. """
-    if not data:
-        prof.log_warning("No node data")
-        return
-    try:
-        return b64decode(data)
-    except:
-        prof.log_warning('b64decode broken')
-        return
-
-
-def _get_request_increment(req_type):
-    global __REQ_INCR
-    last_req_id = __REQ_INCR.get(req_type)
-    if last_req_id:
-        # increment the last request id
-        req_id = last_req_id + 1
-    else:
-        # we need to set an initial request id
-        req_id = 1
-
-    __REQ_INCR[req_type] = req_id
-
-    return '{0}{1}'.format(req_type, req_id)
+def _init_logging():
+    """ Forward the omemo library and core log records to profanity. """
+    log_handler = ProfLogHandler()
+    for name in ('omemo', 'prof_omemo'):
+        logger = logging.getLogger(name)
+        if not any(isinstance(h, ProfLogHandler) for h in logger.handlers):
+            logger.setLevel(logging.DEBUG)
+            logger.addHandler(log_handler)
 
 
 def send_stanza(stanza):
@@ -185,45 +92,36 @@ def send_stanza(stanza):
     prof.send_stanza(stanza)
 
 
-def unpack_encrypted_stanza(encrypted_stanza):
-    """
-    <message id="8d966c20-1690-46eb-b1cd-a7ddcc419fde" to="renevolution@yakshed.org" type="chat" from="testvolution@yakshed.org/conversations">
-    <encrypted xmlns="eu.siacs.conversations.axolotl">
-        <header sid="1461841909">
-            <key rid="1260459496">MwiS5dwDEiEFWjz44O8EezFsoc9bt/o85UIUw4zyXxwX5Fk80dpsvmgaIQVnrk8XTORiGHq2TYRM
-                wS1/WWY+zhN9z1fmazuEOgtfRyJSMwohBe7cHe4zeNI3p4R60hEzY3vwaiPCCDQrr01A+BsyvI0V
-                EAEYACIgAnkiHmEFyNec2UNZi7wRswx36qUYfWYnHcN3qEUQFDYLe51RMqf+NSj134e5BTAB
-            </key>
-            <iv>PnZsChVPjwI6jTL6fpkz5Q==</iv>
-        </header>
-        <payload>5eCvRJz6ASe8YzCyhB6W3JozxHec</payload>
-    </encrypted>
-    <markable xmlns="urn:xmpp:chat-markers:0"/>
-    <store xmlns="urn:xmpp:hints"/></message>
-    :param encrypted_stanza:
-    :return:
-    """
-
-    xml = ET.fromstring(encrypted_stanza)
+def _current_context():
+    """ Return the context of the currently connected account or None. """
+    return __OMEMO_CONTEXTS.current
 
-    encrypted_node = xml.find('.//{%s}encrypted' % NS_OMEMO)
 
-    header_node = encrypted_node.find('.//{%s}header' % NS_OMEMO)
-    sid = int(header_node.attrib['sid'])
+def _run_in_background(work, done):
+    """ Run work() in a thread, then done(result, error) on the main loop.
 
-    iv_node = header_node.find('.//{%s}iv' % NS_OMEMO)
-    iv = iv_node.text
+    prof must only be called from the main loop, so work must not use it.
+    """
+    def run():
+        try:
+            result, error = work(), None
+        except Exception as e:
+            result, error = None, e
+        __MAIN_LOOP_QUEUE.put(lambda: done(result, error))
 
-    payload_node = encrypted_node.find('.//{%s}payload' % NS_OMEMO)
-    payload = payload_node.text
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
 
-    keys = {}
-    for node in header_node.iter():
-        if node.tag == '{%s}key' % NS_OMEMO:
-            keys[int(node.attrib['rid'])] = node.text
 
-    result = {'sid': sid, 'iv': iv, 'keys': keys, 'payload': payload}
-    return result
+def _poll_main_loop_queue():
+    """ Timed callback running what the transfer threads handed over. """
+    while True:
+        try:
+            callback = __MAIN_LOOP_QUEUE.get_nowait()
+        except queue.Empty:
+            return
+        callback()
 
 
 ################################################################################
@@ -232,324 +130,178 @@ def unpack_encrypted_stanza(encrypted_stanza):
 
 
 def _init_omemo(account_name, fulljid):
-    global __OMEMO_ACCOUNT
-    __OMEMO_ACCOUNT = account_name
-    global __OMEMO_FULLJID
-    __OMEMO_FULLJID = fulljid
-    global __OMEMO_STATE
-    __OMEMO_STATE = OmemoState(db())
-    global __OMEMO_BUNDLE
-    __OMEMO_BUNDLE = __OMEMO_STATE.bundle
+    try:
+        context = __OMEMO_CONTEXTS.get(account_name, fulljid)
+    except ImportError:
+        prof.cons_show('Could not import OmemoState')
+        raise
+    __OMEMO_CONTEXTS.current_account = account_name
 
     # subscribe to devicelist updates
     prof.log_info('Adding Disco Feature {0}.'.format(NS_DEVICE_LIST_NOTIFY))
     prof.disco_add_feature(NS_DEVICE_LIST_NOTIFY)
 
     prof.log_info('Announcing own bundle info.')
-    _announce_devicelist()
-    _announce_bundle()
-    query_device_list(__OMEMO_ACCOUNT)
+    _announce_devicelist(context)
+    _announce_bundle(context)
+    query_device_list(context, context.account)
 
+    if context.upload_service is None:
+        _discover_upload_service(context)
 
-def test_send():
 
-    _announce_bundle()
-
-
-def _build_bundle_dict(bundle_xml):
-    # IN
-    # < iq id = "fetch2" to = "renevolution@yakshed.org/profanity" type = "result"
-    # from="bascht@yakshed.org" > < pubsub
-    # xmlns = "http://jabber.org/protocol/pubsub" > < items
-    # node = "eu.siacs.conversations.axolotl.bundles:584672103" > < item
-    # id = "1" > < bundle
-    # xmlns = "eu.siacs.conversations.axolotl" > < signedPreKeyPublic
-    # signedPreKeyId = "201" > BfRvacDSmt9fL4f4jqktjsn + Sj0XHTOaDIrwUHrmm7UM
-    # < / signedPreKeyPublic > < signedPreKeySignature > GoFJNyUAp + +f / S65JEZqXmEp1ywW0pEhnoLRpqmSs1U5nLPDB23w9qDQ2qBoHtzzFV3rFscC0elW
-    # gfQH8QrrhA ==
-    # < / signedPreKeySignature > < identityKey > BcZ44U9DtJUYEEqqRY + a / EBifzrVam + FTEq / aBNyLRAX
-    # < / identityKey > < prekeys > < preKeyPublic
-    # preKeyId = "19951" > BUAt + pvKZuHLbPYESargxpe4s4jsEqxe5sK + xwvt + lYQ
-    # < / preKeyPublic > < preKeyPublic
-    # ...
-    # < / preKeyPublic > < / prekeys > < / bundle > < / item > < / items > < / pubsub > < / iq >
-    #
-    # OUT
-    # result = {
-    #     'signedPreKeyId': signedPreKey.getId(),
-    #     'signedPreKeyPublic':
-    #         b64encode(signedPreKey.getKeyPair().getPublicKey().serialize()),
-    #     'signedPreKeySignature': b64encode(signedPreKey.getSignature()),
-    #     'identityKey':
-    #         b64encode(identityKeyPair.getPublicKey().serialize()),
-    #     'prekeys': prekeys
-    # }
+def test_send():
 
-    prof.log_info('Unwrapping bundle info.')
+    _announce_bundle(_current_context())
 
-    bundle_node = bundle_xml.find('.//{%s}bundle' % NS_OMEMO)
 
-    signedPreKeyPublic_node = bundle_node.find('.//{%s}signedPreKeyPublic' % NS_OMEMO)
-    signedPreKeyPublic = signedPreKeyPublic_node.text
-    signedPreKeyId = int(signedPreKeyPublic_node.attrib['signedPreKeyId'])
+def _announce_bundle(context):
+    send_stanza(omemo_stanza.bundle_announcement(context.account,
+                                                 context.own_device_id,
+                                                 context.bundle))
 
-    signedPreKeySignature_node = bundle_node.find('.//{%s}signedPreKeySignature' % NS_OMEMO)
-    signedPreKeySignature = signedPreKeySignature_node.text
 
-    identityKey_node = bundle_node.find('.//{%s}identityKey' % NS_OMEMO)
-    identityKey = identityKey_node.text
+def _start_omemo_session(context, jid):
+    # should be started before the first message is sent.
+    prof.log_info('Query Devicelist for {0}'.format(jid))
+    query_device_list(context, jid)
+    prof.log_info('Query bundle info for {0}'.format(jid))
+    _fetch_bundle(context, jid)
 
-    prekeys_node = bundle_node.find('.//{%s}prekeys' % NS_OMEMO)
 
-    prekeys = [(int(n.attrib['preKeyId']), n.text) for n in prekeys_node]
+def _end_omemo_session(jid):
+    # TODO: catch window_closed as well
+    pass
 
-    result = {
-        'signedPreKeyId': signedPreKeyId,
-        'signedPreKeyPublic': signedPreKeyPublic,
-        'signedPreKeySignature': signedPreKeySignature,
-        'identityKey': identityKey,
-        'prekeys': prekeys
-    }
 
-    return result
+def _get_payload_backend():
+    """ Return the AES-GCM backend, selecting it on first use. """
+    global __PAYLOAD_BACKEND
+    global __PAYLOAD_BENCH
+    global __PAYLOAD_INSTALLED
+    if __PAYLOAD_BACKEND is not None:
+        return __PAYLOAD_BACKEND
 
+    from prof_omemo.crypto import (PythonBackend, install_payload_backend,
+                                   select_payload_backend)
 
-def _announce_bundle():
-    """ announce bundle info
+    backend, bench = select_payload_backend()
 
-    """
-    # TODO: move it to wrap/unwrap methods
-    announce_template = ('<iq from="{from_jid}" type="set" id="{req_id}">'
-                         '<pubsub xmlns="http://jabber.org/protocol/pubsub">'
-                         '<publish node="{bundles_ns}:{device_id}">'
-                         '<item>'
-                         '<bundle xmlns="{omemo_ns}">'
-                         '</bundle>'
-                         '</item>'
-                         '</publish>'
-                         '</pubsub>'
-                         '</iq>')
-
-    bundle_msg = announce_template.format(from_jid=__OMEMO_ACCOUNT,
-                                          req_id=str(uuid.uuid4()),
-                                          device_id=__OMEMO_STATE.own_device_id,
-                                          bundles_ns=NS_BUNDLES,
-                                          omemo_ns=NS_OMEMO)
-
-    # clean bundle_msg
-    # bundle_msg = bundle_msg.replace('\n', '').replace('\r', '')
-
-    bundle_xml = ET.fromstring(bundle_msg)
-
-    # to be appended to announce_template
-    find_str = './/{%s}bundle' % NS_OMEMO
-    bundle_node = bundle_xml.find(find_str)
-    pre_key_signed_node = ET.SubElement(bundle_node, 'signedPreKeyPublic',
-                                        attrib={'signedPreKeyId': str(__OMEMO_BUNDLE['signedPreKeyId'])})
-    pre_key_signed_node.text = __OMEMO_BUNDLE.get('signedPreKeyPublic')
-
-    signedPreKeySignature_node = ET.SubElement(bundle_node,
-                                               'signedPreKeySignature')
-    signedPreKeySignature_node.text = __OMEMO_BUNDLE.get('signedPreKeySignature')
-
-    identityKey_node = ET.SubElement(bundle_node, 'identityKey')
-    identityKey_node.text = __OMEMO_BUNDLE.get('identityKey')
-
-    prekeys_node = ET.SubElement(bundle_node, 'prekeys')
-    for key_id, key in __OMEMO_BUNDLE.get('prekeys',[]):
-        key_node = ET.SubElement(prekeys_node, 'preKeyPublic',
-                                 attrib={'preKeyId': str(key_id)})
-        key_node.text = key
-
-    # reconvert xml to stanza
-    bundle_stanza = ET.tostring(bundle_xml, encoding='utf8', method='xml')
-    # prof.cons_show(bundle_stanza)
-
-    send_stanza(bundle_stanza)
-
-
-def _start_omemo_session(jid):
-    # should be started before the first message is sent.
-    prof.log_info('Query Devicelist for {0}'.format(jid))
-    query_device_list(jid)
-    prof.log_info('Query bundle info for {0}'.format(jid))
-    _fetch_bundle(jid)
+    for name, speed, _ in bench:
+        if speed is not None:
+            prof.log_info('AES-GCM backend {0}: {1:.1f} KiB/s'.format(
+                name, speed / 1024))
 
+    prof.log_info('Using AES-GCM backend {0}.'.format(backend.name))
+    if backend.name == PythonBackend.name:
+        prof.log_warning('Only the slow pure python AES-GCM backend is '
+                         'available, install cryptography to speed it up.')
 
-def _end_omemo_session(jid):
-    # TODO: catch window_closed as well
-    pass
+    try:
+        installed = install_payload_backend(backend)
+    except Exception as e:
+        prof.log_error('Could not install AES-GCM backend: {0}'.format(e))
+        installed = False
 
-################################################################################
-# Error Handling
-################################################################################
+    if not installed:
+        prof.log_warning('Message payloads use the built-in cipher of the '
+                         'omemo library, the backend is used for files only.')
 
+    # only remember the backend once it is fully set up
+    __PAYLOAD_BACKEND, __PAYLOAD_BENCH = backend, bench
+    __PAYLOAD_INSTALLED = installed
 
-class NoOmemoMessage(Exception):
-    pass
+    return __PAYLOAD_BACKEND
 
 
-class UnhandledOmemoMessage(Exception):
-    pass
+def _show_stats():
+    backend = _get_payload_backend()
+    used_for = 'messages + files' if __PAYLOAD_INSTALLED else 'files only'
+    prof.cons_show('AES-GCM backend: {0} ({1})'.format(backend.name, used_for))
+    for name, speed, note in __PAYLOAD_BENCH:
+        if speed is None:
+            prof.cons_show('  {0}: {1}'.format(name, note))
+        else:
+            prof.cons_show('  {0}: {1:.1f} KiB/s'.format(name, speed / 1024))
 
 ################################################################################
 # Stanza handling
 ################################################################################
 
 
-def _fetch_bundle(recipient):
+def _fetch_bundle(context, recipient):
 
-    recipient_devices = __OMEMO_STATE.device_list_for(recipient)
+    recipient_devices = context.devices.devices(recipient)
     prof.log_info('Fetching bundle for devices {0} of {1}'.format(recipient_devices, recipient))
 
-    for device_id in recipient_devices:
-        bundle_req_root = ET.Element('iq')
-        bundle_req_root.set('type', 'get')
-        bundle_req_root.set('from', __OMEMO_ACCOUNT)
-        bundle_req_root.set('to', recipient)
-        bundle_req_root.set('id', str(uuid.uuid4()))
-        pubsub_node = ET.SubElement(bundle_req_root, 'pubsub')
-        pubsub_node.set('xmlns', 'http://jabber.org/protocol/pubsub')
-        items_node = ET.SubElement(pubsub_node, 'items')
-        items_node.set('node', '{0}:{1}'.format(NS_BUNDLES, device_id))
-
-        stanza = ET.tostring(bundle_req_root, encoding='utf8', method='xml')
+    for stanza in omemo_stanza.bundle_requests(context.account, recipient,
+                                               recipient_devices):
         send_stanza(stanza)
 
 
-def _handle_devicelist_update(stanza):
-    """
-    <message from='juliet@capulet.lit'
-        to='romeo@montague.lit'
-        type='headline'
-        id='update_01'>
-        <event xmlns='http://jabber.org/protocol/pubsub#event'>
-            <items node='urn:xmpp:omemo:0:devicelist'>
-            <item>
-                <list xmlns='urn:xmpp:omemo:0'>
-                <device id='12345' />
-                <device id='4223' />
-                </list>
-            </item>
-            </items>
-        </event>
-    </message>
-
-
-
-    NS_DEVICELIST
-    <message to="renevolution@yakshed.org/profanity"
-           type="headline" from="bascht@yakshed.org"><event
-           xmlns="http://jabber.org/protocol/pubsub#event"><items
-           node="eu.siacs.conversations.axolotl.devicelist"><item
-           id="1"><list
-           xmlns="eu.siacs.conversations.axolotl"><device
-           id="259621345"/><device
-           id="584672103"/></list></item></items></event></message>
-
-    """
-    xml = ET.fromstring(stanza)
-
-    try:
-        sender_jid = xml.attrib.get('from')
-    except AttributeError:
-        sender_jid = None
-
+def _handle_devicelist_update(context, stanza):
+    sender_jid, device_ids = omemo_stanza.parse_devicelist_update(stanza)
     if sender_jid is None:
-        event_node = xml.find('./{%s}event' % 'http://jabber.org/protocol/pubsub#event')
-        try:
-            sender_jid = event_node.attrib.get('from')
-        except AttributeError:
-            prof.log_error('Could not find Sender in stanza: {0}'.format(stanza))
-            return
-
-    item_list = xml.find('.//{%s}list' % NS_OMEMO)
-    if item_list is None or len(item_list) <= 0:
-        prof.log_error('pubsub node not found.')
-        prof.log_error(stanza)
         return
 
-    device_ids = [d.attrib['id'] for d in list(item_list)]
-
     if device_ids:
         prof.log_info('Adding Device ID\'s: {0} for {1}.'.format(device_ids,
                                                                  sender_jid))
 
-        global __OMEMO_STATE
-        __OMEMO_STATE.add_devices(sender_jid, device_ids)
+        context.devices.update(sender_jid, device_ids)
 
         prof.log_info('Device List update done.')
 
-    add_recipient_to_completer(sender_jid)
+    add_recipient_to_completer(context, sender_jid)
+
 
+def add_recipient_to_completer(context, recipient):
+    if recipient in context.completer_jids:
+        return
+    context.completer_jids.add(recipient)
 
-def add_recipient_to_completer(recipient):
     prof.completer_add('/omemo start', [recipient])
     prof.completer_add('/omemo show_devices', [recipient])
+    prof.completer_add('/omemo trust', [recipient])
+
+
+def _warn_identity_change(jid, device_id):
+    prof.cons_alert()
+    prof.cons_show('WARNING: The OMEMO identity key of {0} (device {1}) has '
+                   'changed!'.format(jid, device_id))
+    prof.cons_show('Verify the new key with your contact, then accept it with '
+                   '/omemo trust {0} {1}'.format(jid, device_id))
 
 
-def _handle_bundle_update(stanza):
+def _handle_bundle_update(context, stanza):
     prof.log_info('Bundle Information received.')
-    bundle_xml = ET.fromstring(stanza)
-    bundle_info = _build_bundle_dict(bundle_xml)
-    sender = bundle_xml.attrib['from'].rsplit('/', 1)[0]
+    sender, device_id, bundle_info = omemo_stanza.parse_bundle_update(stanza)
 
-    items_node = bundle_xml.find(
-        './/{%s}items' % 'http://jabber.org/protocol/pubsub')
-    device_id = items_node.attrib['node'].split(':')[-1]
-    global __OMEMO_STATE
-    session_cipher = __OMEMO_STATE.build_session(sender, device_id, bundle_info)
+    built, identity_changed = context.build_session(sender, device_id,
+                                                    bundle_info)
+    if identity_changed:
+        _warn_identity_change(sender, device_id)
 
-    prof.log_info('Session built with user: {0} '.format(sender))
+    if built:
+        prof.log_info('Session built with user: {0} '.format(sender))
 
 
 def _handle_omemo_message(encrypted_node):
     pass
 
 
-def _announce_devicelist():
-
-    QUERY_MSG = ('<iq type="set" from="{from}" id="{id}">'
-                 '<pubsub xmlns="http://jabber.org/protocol/pubsub">'
-                 '<publish node="{devicelist_ns}">'
-                 '<item id="1">'
-                 '<list xmlns="{omemo_ns}">'
-                 '{devices}'
-                 '</list>'
-                 '</item>'
-                 '</publish>'
-                 '</pubsub>'
-                 '</iq>')
-
-    device_nodes = ['<device id="{0}"/>'.format(d) for d in [__OMEMO_STATE.own_device_id]]
-
-    msg_dict = {'from': __OMEMO_FULLJID,
-                'devices': ''.join(device_nodes),
-                'id': str(uuid.uuid4()),
-                'omemo_ns': NS_OMEMO,
-                'devicelist_ns': NS_DEVICE_LIST}
-
-    query_msg = QUERY_MSG.format(**msg_dict)
+def _announce_devicelist(context):
+    query_msg = omemo_stanza.devicelist_announcement(context.fulljid,
+                                                     [context.own_device_id])
 
     prof.log_info('Sending Device List Update: {0}'.format(query_msg))
     send_stanza(query_msg)
 
 
-def query_device_list(contact_jid):
+def query_device_list(context, contact_jid):
     prof.log_info('Query Device List for {0}'.format(contact_jid))
 
-    QUERY_MSG = ('<iq type="get" from="{from}" to="{to}" id="{id}">'
-                 '<pubsub xmlns="http://jabber.org/protocol/pubsub">'
-                 '<items node="{device_list_ns}" />'
-                 '</pubsub>'
-                 '</iq>')
-
-    msg_dict = {'from': __OMEMO_FULLJID,
-                'to': contact_jid,
-                'id': str(uuid.uuid4()),
-                'device_list_ns': NS_DEVICE_LIST}
-
-    query_msg = QUERY_MSG.format(**msg_dict)
+    query_msg = omemo_stanza.devicelist_query(context.fulljid, contact_jid)
 
     prof.log_info('Sending Device List Query: {0}'.format(query_msg))
     send_stanza(query_msg)
@@ -557,52 +309,209 @@ def query_device_list(contact_jid):
 
 def encrypted_from_stanza(stanza):
     msg_xml = ET.fromstring(stanza)
-    from_jid = __OMEMO_FULLJID
-    jid = msg_xml.attrib['to']
-    raw_jid = jid.rsplit('/', 1)[0]
+    context = __OMEMO_CONTEXTS.for_stanza(msg_xml, outgoing=True)
+    from_jid = context.fulljid
+    raw_jid, plaintext = omemo_stanza.message_body(stanza)
 
-    body_node = msg_xml.find('.//body')
-    plaintext = body_node.text
+    return encrypted(context, from_jid, raw_jid, plaintext)
 
-    return encrypted(from_jid, raw_jid, plaintext)
 
+def encrypted(context, from_jid, to_jid, plaintext):
 
-def encrypted(from_jid, to_jid, plaintext):
+    prof.log_info('Get Message Data >> FROM: {0} >> TO: {1} >> MSG: {2}'.format(from_jid, to_jid, plaintext))
+    msg_dict = context.state.create_msg(from_jid, to_jid, plaintext)
 
-    OMEMO_MSG = ('<message to="{to}" from="{from}" id="{id}" type="chat">'
-                 '<encrypted xmlns="{omemo_ns}">'
-                 '<header sid="{sid}">'
-                 '{keys}'
-                 '<iv>{iv}</iv>'
-                 '</header>'
-                 '<payload>{enc_body}</payload>'
-                 '</encrypted>'
-                 '<store xmlns="urn:xmpp:hints"/>'
-                 '</message>')
+    return omemo_stanza.encrypted_message(from_jid, to_jid, msg_dict)
 
-    prof.log_info('Get Message Data >> FROM: {0} >> TO: {1} >> MSG: {2}'.format(from_jid, to_jid, plaintext))
-    msg_dict = __OMEMO_STATE.create_msg(from_jid, to_jid, plaintext)
+################################################################################
+# Encrypted file transfer
+################################################################################
+
+
+def _discover_upload_service(context):
+    """ Query the items of our server for a HTTP upload component. """
+    req_id = context.request_id('omemo-disco-items')
+    context.pending[req_id] = _handle_disco_items
+    send_stanza(omemo_stanza.disco_query(context.fulljid,
+                                         context.barejid.split('@')[-1],
+                                         req_id, NS_DISCO_ITEMS))
+
+
+def _handle_disco_items(context, xml):
+    if omemo_stanza.is_iq_error(xml):
+        return
+
+    for jid in omemo_stanza.disco_item_jids(xml):
+        req_id = context.request_id('omemo-disco-info')
+        context.pending[req_id] = _handle_disco_info
+        send_stanza(omemo_stanza.disco_query(context.fulljid, jid, req_id,
+                                             NS_DISCO_INFO))
 
-    # build encrypted message from here
-    keys_dict = msg_dict['keys']
-    keys_str = ''.join(
-        ['<key rid="{0}">{1}</key>'.format(rid, key) for rid, key in
-         keys_dict.iteritems()])
 
-    msg_dict = {'to': to_jid,
-                'from': from_jid,
-                'id': str(uuid.uuid4()),
-                'omemo_ns': NS_OMEMO,
-                'sid': msg_dict['sid'],
-                'keys': keys_str,
-                'iv': msg_dict['iv'],
-                'enc_body': msg_dict['payload']}
+def _handle_disco_info(context, xml):
+    if omemo_stanza.is_iq_error(xml):
+        return
+
+    if omemo_stanza.has_disco_feature(xml, NS_HTTP_UPLOAD):
+        context.upload_service = xml.attrib.get('from')
+        prof.log_info('Using HTTP upload service {0}.'.format(
+            context.upload_service))
+
+
+def _send_file(context, recipient, path):
+    """ Request an upload slot for the file at path.
+
+    The file is encrypted while it is uploaded once the slot request has
+    been answered. It is dropped on disconnect or when no slot arrives in
+    time.
+    """
+    if context.upload_service is None:
+        prof.cons_show('No HTTP upload service found on your server.')
+        return
+
+    path = os.path.expanduser(path)
+    if not os.path.isfile(path):
+        prof.cons_show('File not found: {0}'.format(path))
+        return
+
+    upload = {'recipient': recipient,
+              'path': path,
+              'size': os.path.getsize(path),
+              'key': os.urandom(32),
+              'iv': os.urandom(12),
+              'expires': time.time() + UPLOAD_SLOT_TIMEOUT}
 
-    enc_msg = OMEMO_MSG.format(**msg_dict)
+    req_id = context.request_id('omemo-upload')
+    context.uploads[req_id] = upload
+    context.pending[req_id] = \
+        lambda ctx, xml: _handle_upload_slot(ctx, xml, req_id)
 
-    return enc_msg
+    prof.cons_show('Requesting upload slot for {0}...'.format(path))
+    send_stanza(omemo_stanza.upload_slot_request(
+        context.fulljid, context.upload_service, req_id,
+        os.path.basename(path), upload['size'] + AESGCM_TAG_SIZE))
 
 
+def _discard_upload(context, req_id):
+    """ Forget a file waiting for its upload slot. """
+    context.uploads.pop(req_id)
+    context.pending.pop(req_id, None)
+
+
+def _expire_uploads():
+    """ Timed callback dropping uploads whose slot request went unanswered. """
+    context = _current_context()
+    if context is None:
+        return
+
+    now = time.time()
+    for req_id, upload in list(context.uploads.items()):
+        if upload['expires'] < now:
+            _discard_upload(context, req_id)
+            prof.cons_show('Upload slot request for {0} timed out.'.format(
+                upload['recipient']))
+
+
+def _handle_upload_slot(context, xml, req_id):
+    from prof_omemo.crypto import build_aesgcm_url
+    from prof_omemo.transfer import upload_file
+
+    upload = context.uploads.pop(req_id, None)
+    if upload is None:
+        # expired or discarded meanwhile
+        return
+
+    if omemo_stanza.is_iq_error(xml):
+        prof.cons_show('Upload slot request failed.')
+        return
+
+    try:
+        put_url, get_url, headers = omemo_stanza.parse_upload_slot(xml)
+    except Exception as e:
+        prof.log_error('Invalid upload slot: {0}'.format(e))
+        prof.cons_show('Upload slot request failed: invalid slot received.')
+        return
+
+    backend = _get_payload_backend()
+
+    def put():
+        return upload_file(backend, put_url, headers, upload['path'],
+                           upload['size'], upload['key'], upload['iv'])
+
+    def uploaded(status, error):
+        if error is not None:
+            prof.log_error('Upload to {0} failed: {1}'.format(put_url, error))
+            prof.cons_show('Upload failed: {0}'.format(error))
+            return
+
+        if status not in (200, 201):
+            prof.cons_show('Upload failed with HTTP status {0}.'.format(status))
+            return
+
+        if _current_context() is not context:
+            prof.cons_show('Disconnected during upload, file not sent to '
+                           '{0}.'.format(upload['recipient']))
+            return
+
+        link = build_aesgcm_url(get_url, upload['key'], upload['iv'])
+        send_stanza(encrypted(context, context.fulljid, upload['recipient'],
+                              link))
+        prof.cons_show('File sent to {0}.'.format(upload['recipient']))
+
+    prof.cons_show('Encrypting and uploading file for {0}...'.format(
+        upload['recipient']))
+    _run_in_background(put, uploaded)
+
+
+def _receive_file(context, sender, resource, aesgcm_url):
+    """ Download and decrypt an aesgcm:// link in the background. """
+    from prof_omemo.transfer import download_file
+
+    backend = _get_payload_backend()
+    download_dir = os.path.join(get_local_data_path(context.account),
+                                'downloads')
+    max_mb = _max_download_mb()
+    max_size = max_mb * 1024 * 1024 if max_mb > 0 else None
+
+    def done(file_path, error):
+        if error is None:
+            msg = 'File received: {0}'.format(file_path)
+        elif isinstance(error, DownloadTooLarge):
+            msg = ('File not downloaded, it is larger than {0} MiB. Raise the '
+                   'limit with /omemo max_download.'.format(max_mb))
+        else:
+            prof.log_error('Download of {0} failed: {1}'.format(aesgcm_url,
+                                                                error))
+            msg = 'Could not download file: {0}'.format(error)
+        prof.incoming_message(sender, resource, '[*OMEMO*] {}'.format(msg))
+
+    _run_in_background(
+        lambda: download_file(backend, aesgcm_url, download_dir, max_size),
+        done)
+
+
+def _max_download_mb():
+    return prof.settings_int_get('omemo', 'max_download_mb', MAX_DOWNLOAD_MB)
+
+
+def _set_max_download(value):
+    if value is not None:
+        try:
+            max_mb = int(value)
+        except ValueError:
+            max_mb = -1
+        if max_mb < 0:
+            prof.cons_show('Invalid size: {0}'.format(value))
+            return
+        prof.settings_int_set('omemo', 'max_download_mb', max_mb)
+
+    max_mb = _max_download_mb()
+    if max_mb > 0:
+        prof.cons_show('Incoming files up to {0} MiB are downloaded.'.format(
+            max_mb))
+    else:
+        prof.cons_show('Incoming files are downloaded regardless of size.')
+
 ################################################################################
 # Sending hooks
 ################################################################################
@@ -647,22 +556,31 @@ def prof_on_message_stanza_receive(stanza):
     prof.log_info('Received Message: {0}'.format(stanza))
     if NS_DEVICE_LIST in stanza:
         prof.log_info('Device List update detected.')
-        _handle_devicelist_update(stanza)
+        xml = ET.fromstring(stanza)
+        _handle_devicelist_update(__OMEMO_CONTEXTS.for_stanza(xml), stanza)
         return False
 
     if 'encrypted' in stanza:
         xml = ET.fromstring(stanza)
+        context = __OMEMO_CONTEXTS.for_stanza(xml)
         sender_fulljid = xml.attrib['from']
         sender, resource = sender_fulljid.rsplit('/', 1)
         try:
-            msg_dict = unpack_encrypted_stanza(stanza)
+            msg_dict = omemo_stanza.unpack_encrypted_stanza(stanza)
             msg_dict['sender_jid'] = sender
 
-            plain_msg = __OMEMO_STATE.decrypt_msg(msg_dict)
+            if msg_dict['sid'] not in context.devices.devices(sender):
+                # message from a device we do not know yet
+                query_device_list(context, sender)
+
+            plain_msg = context.state.decrypt_msg(msg_dict)
             prof.log_info('Received Plain Message: {}'.format(plain_msg))
             if plain_msg:
                 prefixed_msg = '[*OMEMO*] {}'.format(plain_msg)
                 prof.incoming_message(sender, resource, prefixed_msg)
+            if plain_msg and plain_msg.startswith('aesgcm://'):
+                # the link is shown already, the file follows when downloaded
+                _receive_file(context, sender, resource, plain_msg)
             return False
         except Exception as e:
             # maybe not OMEMO encrypted, profanity will take care then
@@ -682,15 +600,25 @@ def prof_on_iq_stanza_receive(stanza):
     # prof_incoming_message() and return FALSE
     prof.log_info('Received IQ: {0}'.format(stanza))
 
+    xml = ET.fromstring(stanza)
+    context = __OMEMO_CONTEXTS.for_stanza(xml)
+    if context is None:
+        return True
+
+    callback = context.pending.pop(xml.attrib.get('id'), None)
+    if callback is not None:
+        callback(context, xml)
+        return False
+
     if NS_BUNDLES in stanza:  # bundle information received
         prof.log_info('Bundle update detected.')
-        _handle_bundle_update(stanza)
+        _handle_bundle_update(context, stanza)
         return False
 
     elif NS_DEVICE_LIST in stanza and not NS_DEVICE_LIST_NOTIFY in stanza:
         # TODO: find a better way to check for devicelist updates
         prof.log_info('Device List update detected.')
-        _handle_devicelist_update(stanza)
+        _handle_devicelist_update(context, stanza)
         return False
 
     return True
@@ -702,20 +630,49 @@ def prof_on_iq_stanza_receive(stanza):
 
 def _handle_win_input(recipient, msg):
     prof.log_info('Win Input: {0} - {1}'.format(recipient, msg))
-    send_stanza(encrypted(__OMEMO_ACCOUNT, recipient, msg))
+    context = _current_context()
+    send_stanza(encrypted(context, context.account, recipient, msg))
+
 
+def _format_device(device_id, flags):
+    states = ['active' if flags & DEVICE_ACTIVE else 'inactive']
+    states.append('trusted' if flags & DEVICE_TRUSTED else 'not trusted')
+    return '{0} ({1})'.format(device_id, ', '.join(states))
 
-def _parse_args(arg1=None, arg2=None):
+
+def _parse_args(arg1=None, arg2=None, arg3=None):
     """ Parse arguments given in command window
 
     arg1: start || end
     arg2: muc || jid (optional)
 
+    arg1: sendfile
+    arg2: path of the file to send to the current recipient
+
+    arg1: trust
+    arg2: jid
+    arg3: device id whose current identity key is accepted
+
+    arg1: max_download
+    arg2: size limit of incoming files in MiB, 0 for none (optional)
+
     Starts or ends an encrypted chat session
 
     """
+    if arg1 == "stats":
+        _show_stats()
+        return
+    elif arg1 == "max_download":
+        _set_max_download(arg2)
+        return
+
+    context = _current_context()
+    if context is None:
+        prof.cons_show('OMEMO is not initialized, please connect first.')
+        return
+
     if arg1 == "announce":
-        _announce_bundle()
+        _announce_bundle(context)
     elif arg1 == "start" :
         # ensure we are in a chat window
         if arg2:
@@ -725,19 +682,38 @@ def _parse_args(arg1=None, arg2=None):
         prof.log_info('Start OMEMO session with: {0}'.format(muc))
         if muc:
             # prof.win_show(win_name, 'Starting OMEMO Session')
-            _start_omemo_session(muc)
+            _start_omemo_session(context, muc)
 
     elif arg1 == "account":
-        prof.cons_show('Account: {0}'.format(__OMEMO_ACCOUNT))
+        prof.cons_show('Account: {0}'.format(context.account))
     elif arg1 == "device":
-        prof.cons_show('Device-ID: {0}'.format(__OMEMO_STATE.own_device_id))
+        prof.cons_show('Device-ID: {0}'.format(context.own_device_id))
     elif arg1 == "fulljid":
-        prof.cons_show('Current JID: {0}'.format(__OMEMO_FULLJID))
+        prof.cons_show('Current JID: {0}'.format(context.fulljid))
     elif arg1 == "show_devices" and arg2 is not None:
         prof.cons_show('Requesting Devices...')
-        devices = __OMEMO_STATE.device_list_for(arg2)
-        prof.cons_show('Devices: {0}'.format(devices))
-        prof.cons_show('{0}: {1}'.format(arg2, ', '.join(devices)))
+        devices = context.devices.flags(arg2)
+        prof.cons_show('{0}: {1}'.format(arg2, ', '.join(
+            _format_device(device_id, flags) for device_id, flags in devices)))
+    elif arg1 == "trust" and arg3 is not None:
+        try:
+            device_id = int(arg3)
+        except ValueError:
+            prof.cons_show('Invalid device id: {0}'.format(arg3))
+            return
+
+        if context.trust_device(arg2, device_id):
+            prof.cons_show('Trusting device {0} of {1}.'.format(device_id,
+                                                               arg2))
+        else:
+            prof.cons_show('No verified identity for device {0} of {1}.'
+                           .format(device_id, arg2))
+    elif arg1 == "sendfile" and arg2 is not None:
+        recipient = prof.get_current_recipient()
+        if recipient:
+            _send_file(context, recipient, arg2)
+        else:
+            prof.cons_show('sendfile must be used in a chat window.')
     elif arg1 == "test":
         test_send()
 
@@ -748,13 +724,21 @@ def _parse_args(arg1=None, arg2=None):
 
 def prof_init(version, status, account_name, fulljid):
 
+    _init_logging()
+    prof.register_timed(_poll_main_loop_queue, 1)
+    prof.register_timed(_expire_uploads, 10)
+
     synopsis = [
         "/omemo",
         "/omemo start|end [jid]",
         "/omemo announce",
         "/omemo account",
         "/omemo fulljid",
-        "/omemo show_devices"
+        "/omemo show_devices",
+        "/omemo sendfile <path>",
+        "/omemo trust <jid> <device>",
+        "/omemo max_download [<MiB>]",
+        "/omemo stats"
     ]
 
     description = "Plugin to enable OMEMO encryption"
@@ -762,18 +746,42 @@ def prof_init(version, status, account_name, fulljid):
         ["start|end <jid>", ("Start an OMEMO based conversation with <jid> "
                              "window or current window.")],
         ["account", "Show current account name"],
-        ["fulljid", "Show current <full-jid>"]
+        ["fulljid", "Show current <full-jid>"],
+        ["sendfile <path>", ("Encrypt and upload the file at <path> and "
+                             "send the link to the current recipient.")],
+        ["trust <jid> <device>", ("Accept the current identity key of "
+                                  "<device>. Trust is informational only, "
+                                  "sessions are used either way.")],
+        ["max_download [<MiB>]", ("Show or set the size limit of incoming "
+                                  "files, 0 downloads files of any size.")],
+        ["stats", "Show the AES-GCM backend in use and its benchmark"]
     ]
 
     examples = []
 
     # ensure the plugin is not registered if python-omemo is not available
-    prof.register_command("/omemo", 1, 2,
+    prof.register_command("/omemo", 1, 3,
                           synopsis, description, args, examples, _parse_args)
 
-    prof.completer_add("/omemo", ["start", "end", "announce", "account", "fulljid", "show_devices"])
+    prof.completer_add("/omemo", [
+        "start", "end", "announce", "account", "fulljid", "show_devices",
+        "sendfile", "trust", "max_download", "stats"
+    ])
 
 
 def prof_on_connect(account_name, fulljid):
     prof.log_info('Initializing Profanity OMEMO Plugin...')
+    # select the payload backend before any message is en- or decrypted
+    _get_payload_backend()
     _init_omemo(account_name, fulljid)
+
+
+def prof_on_disconnect(account_name, fulljid):
+    # keep the context around, a reconnect will pick it up again
+    if __OMEMO_CONTEXTS.current_account == account_name:
+        context = __OMEMO_CONTEXTS.current
+        if context is not None:
+            # slot answers can no longer arrive for uploads of this session
+            for req_id in list(context.uploads):
+                _discard_upload(context, req_id)
+        __OMEMO_CONTEXTS.current_account = None
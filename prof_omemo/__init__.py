@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+""" Core of the profanity OMEMO plugin to encrypt/decrypt messages using axolotl
+
+The package holds everything that does not need profanity: stanza parsing
+and building (stanza), per-account state (state), AES-GCM backends
+(crypto) and encrypted HTTP file transfer (transfer). Importing it is
+cheap, the omemo library and crypto packages are only loaded on first use,
+so it can be used by headless bots and the benchmarks as well. omemo.py is
+the thin profanity adapter on top of it.
+
+Workflow:
+
+- Init
+    Create Keypair if not existent
+    Create sqlite db if necessary
+    Announce own device to support OMEMO
+
+- Receive Messages
+    - Get devicelist updates and cache them
+    - If a device receives an update  -> check if own device is still announced.
+      If not re-announce
+
+    Furthermore, a device MUST announce it’s IdentityKey, a signed PreKey,
+    and a list of PreKeys in a separate, per-device PEP node.
+    The list SHOULD contain 100 PreKeys, but MUST contain no less than 20.
+
+- Build a Session
+    - fetch their bundle
+
+- Sending a Message
+    In order to send a chat message, its <body> first has to be encrypted.
+    The client MUST use fresh, randomly generated key/IV pairs with AES-128 in
+    Galois/Counter Mode (GCM). For each intended recipient device, i.e. both
+    own devices as well as devices associated with the contact, this key is
+    encrypted using the corresponding long-standing axolotl session.
+    Each encrypted payload key is tagged with the recipient device’s ID.
+    This is all serialized into a MessageElement,
+    which is transmitted in a <message> as follows:
+
+
+- Sending a key
+    The client may wish to transmit keying material to the contact. This
+    first has to be generated. The client MUST generate a fresh, randomly
+    generated key/IV pair. For each intended recipient device, i.e. both own
+    devices as well as devices associated with the contact, this key is
+    encrypted using the corresponding long-standing axolotl session.
+    Each encrypted payload key is tagged with the recipient device’s ID.
+    This is all serialized into a KeyTransportElement,
+    omitting the <payload> as follows:
+
+"""
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+""" Namespaces and tunables shared by the OMEMO core modules. """
+from array import array
+
+# OMEMO static namespace vars
+NS_OMEMO = 'eu.siacs.conversations.axolotl'
+NS_DEVICE_LIST = NS_OMEMO + '.devicelist'
+NS_DEVICE_LIST_NOTIFY = NS_DEVICE_LIST + '+notify'
+NS_BUNDLES = NS_OMEMO + '.bundles'
+NS_PUBSUB = 'http://jabber.org/protocol/pubsub'
+NS_PUBSUB_EVENT = 'http://jabber.org/protocol/pubsub#event'
+NS_DISCO_ITEMS = 'http://jabber.org/protocol/disco#items'
+NS_DISCO_INFO = 'http://jabber.org/protocol/disco#info'
+NS_HTTP_UPLOAD = 'urn:xmpp:http:upload:0'
+
+# trust states of verified identities
+# signature verified, the identity key was not accepted by the user yet
+TRUST_UNDECIDED = 1
+# the identity key differs from the one verified before
+TRUST_CHANGED = 2
+# the identity key was accepted by the user
+TRUST_ACCEPTED = 3
+
+# device flags kept by the DeviceRegistry
+DEVICE_ACTIVE = 1
+DEVICE_TRUSTED = 2
+
+# device ids are 31 bit, use the smallest array type holding them
+DEVICE_ID_TYPECODE = 'I' if array('I').itemsize >= 4 else 'L'
+
+# files are en-/decrypted in chunks of this size to keep memory use flat
+FILE_CHUNK_SIZE = 64 * 1024
+AESGCM_TAG_SIZE = 16
+HTTP_TIMEOUT = 30
+# default limit in MiB for incoming files, 0 disables the limit
+MAX_DOWNLOAD_MB = 100
+# seconds to wait for the answer to an upload slot request
+UPLOAD_SLOT_TIMEOUT = 60
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+
+class NoOmemoMessage(Exception):
+    pass
+
+
+class UnhandledOmemoMessage(Exception):
+    pass
+
+
+class InvalidPayloadTag(Exception):
+    pass
+
+
+class DownloadTooLarge(Exception):
+    pass
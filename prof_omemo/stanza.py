@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+""" Parsing and building of the stanzas exchanged for OMEMO. """
+import logging
+import uuid
+from base64 import b64decode
+
+try:
+    from lxml import etree as ET
+except ImportError:
+    # fallback to the default ElementTree module
+    import xml.etree.ElementTree as ET
+
+from prof_omemo.constants import (NS_BUNDLES, NS_DEVICE_LIST, NS_DISCO_INFO,
+                                  NS_DISCO_ITEMS, NS_HTTP_UPLOAD, NS_OMEMO,
+                                  NS_PUBSUB, NS_PUBSUB_EVENT)
+
+logger = logging.getLogger(__name__)
+
+
+def decode_data(data):
+    """ Fetch the data from specified node and b64decode it. """
+    if not data:
+        logger.warning("No node data")
+        return
+    try:
+        return b64decode(data)
+    except:
+        logger.warning('b64decode broken')
+        return
+
+
+def is_iq_error(xml):
+    if xml.attrib.get('type') == 'error':
+        logger.error('IQ request failed: {0}'.format(ET.tostring(xml)))
+        return True
+    return False
+
+
+def unpack_encrypted_stanza(encrypted_stanza):
+    """
+    <message id="8d966c20-1690-46eb-b1cd-a7ddcc419fde" to="renevolution@yakshed.org" type="chat" from="testvolution@yakshed.org/conversations">
+    <encrypted xmlns="eu.siacs.conversations.axolotl">
+        <header sid="1461841909">
+            <key rid="1260459496">MwiS5dwDEiEFWjz44O8EezFsoc9bt/o85UIUw4zyXxwX5Fk80dpsvmgaIQVnrk8XTORiGHq2TYRM
+                wS1/WWY+zhN9z1fmazuEOgtfRyJSMwohBe7cHe4zeNI3p4R60hEzY3vwaiPCCDQrr01A+BsyvI0V
+                EAEYACIgAnkiHmEFyNec2UNZi7wRswx36qUYfWYnHcN3qEUQFDYLe51RMqf+NSj134e5BTAB
+            </key>
+            <iv>PnZsChVPjwI6jTL6fpkz5Q==</iv>
+        </header>
+        <payload>5eCvRJz6ASe8YzCyhB6W3JozxHec</payload>
+    </encrypted>
+    <markable xmlns="urn:xmpp:chat-markers:0"/>
+    <store xmlns="urn:xmpp:hints"/></message>
+    :param encrypted_stanza:
+    :return:
+    """
+
+    xml = ET.fromstring(encrypted_stanza)
+
+    encrypted_node = xml.find('.//{%s}encrypted' % NS_OMEMO)
+
+    header_node = encrypted_node.find('.//{%s}header' % NS_OMEMO)
+    sid = int(header_node.attrib['sid'])
+
+    iv_node = header_node.find('.//{%s}iv' % NS_OMEMO)
+    iv = iv_node.text
+
+    payload_node = encrypted_node.find('.//{%s}payload' % NS_OMEMO)
+    payload = payload_node.text
+
+    keys = {}
+    for node in header_node.iter():
+        if node.tag == '{%s}key' % NS_OMEMO:
+            keys[int(node.attrib['rid'])] = node.text
+
+    result = {'sid': sid, 'iv': iv, 'keys': keys, 'payload': payload}
+    return result
+
+
+def build_bundle_dict(bundle_xml):
+    # IN
+    # < iq id = "fetch2" to = "renevolution@yakshed.org/profanity" type = "result"
+    # from="bascht@yakshed.org" > < pubsub
+    # xmlns = "http://jabber.org/protocol/pubsub" > < items
+    # node = "eu.siacs.conversations.axolotl.bundles:584672103" > < item
+    # id = "1" > < bundle
+    # xmlns = "eu.siacs.conversations.axolotl" > < signedPreKeyPublic
+    # signedPreKeyId = "201" > BfRvacDSmt9fL4f4jqktjsn + Sj0XHTOaDIrwUHrmm7UM
+    # < / signedPreKeyPublic > < signedPreKeySignature > GoFJNyUAp + +f / S65JEZqXmEp1ywW0pEhnoLRpqmSs1U5nLPDB23w9qDQ2qBoHtzzFV3rFscC0elW
+    # gfQH8QrrhA ==
+    # < / signedPreKeySignature > < identityKey > BcZ44U9DtJUYEEqqRY + a / EBifzrVam + FTEq / aBNyLRAX
+    # < / identityKey > < prekeys > < preKeyPublic
+    # preKeyId = "19951" > BUAt + pvKZuHLbPYESargxpe4s4jsEqxe5sK + xwvt + lYQ
+    # < / preKeyPublic > < preKeyPublic
+    # ...
+    # < / preKeyPublic > < / prekeys > < / bundle > < / item > < / items > < / pubsub > < / iq >
+    #
+    # OUT
+    # result = {
+    #     'signedPreKeyId': signedPreKey.getId(),
+    #     'signedPreKeyPublic':
+    #         b64encode(signedPreKey.getKeyPair().getPublicKey().serialize()),
+    #     'signedPreKeySignature': b64encode(signedPreKey.getSignature()),
+    #     'identityKey':
+    #         b64encode(identityKeyPair.getPublicKey().serialize()),
+    #     'prekeys': prekeys
+    # }
+
+    logger.info('Unwrapping bundle info.')
+
+    bundle_node = bundle_xml.find('.//{%s}bundle' % NS_OMEMO)
+
+    signedPreKeyPublic_node = bundle_node.find('.//{%s}signedPreKeyPublic' % NS_OMEMO)
+    signedPreKeyPublic = signedPreKeyPublic_node.text
+    signedPreKeyId = int(signedPreKeyPublic_node.attrib['signedPreKeyId'])
+
+    signedPreKeySignature_node = bundle_node.find('.//{%s}signedPreKeySignature' % NS_OMEMO)
+    signedPreKeySignature = signedPreKeySignature_node.text
+
+    identityKey_node = bundle_node.find('.//{%s}identityKey' % NS_OMEMO)
+    identityKey = identityKey_node.text
+
+    prekeys_node = bundle_node.find('.//{%s}prekeys' % NS_OMEMO)
+
+    prekeys = [(int(n.attrib['preKeyId']), n.text) for n in prekeys_node]
+
+    result = {
+        'signedPreKeyId': signedPreKeyId,
+        'signedPreKeyPublic': signedPreKeyPublic,
+        'signedPreKeySignature': signedPreKeySignature,
+        'identityKey': identityKey,
+        'prekeys': prekeys
+    }
+
+    return result
+
+
+def parse_bundle_update(stanza):
+    """ Return sender, device id and bundle dict of a bundle result. """
+    bundle_xml = ET.fromstring(stanza)
+    bundle_info = build_bundle_dict(bundle_xml)
+    sender = bundle_xml.attrib['from'].rsplit('/', 1)[0]
+
+    items_node = bundle_xml.find('.//{%s}items' % NS_PUBSUB)
+    device_id = int(items_node.attrib['node'].split(':')[-1])
+
+    return sender, device_id, bundle_info
+
+
+def parse_devicelist_update(stanza):
+    """
+    <message from='juliet@capulet.lit'
+        to='romeo@montague.lit'
+        type='headline'
+        id='update_01'>
+        <event xmlns='http://jabber.org/protocol/pubsub#event'>
+            <items node='urn:xmpp:omemo:0:devicelist'>
+            <item>
+                <list xmlns='urn:xmpp:omemo:0'>
+                <device id='12345' />
+                <device id='4223' />
+                </list>
+            </item>
+            </items>
+        </event>
+    </message>
+
+
+    NS_DEVICELIST
+    <message to="renevolution@yakshed.org/profanity"
+           type="headline" from="bascht@yakshed.org"><event
+           xmlns="http://jabber.org/protocol/pubsub#event"><items
+           node="eu.siacs.conversations.axolotl.devicelist"><item
+           id="1"><list
+           xmlns="eu.siacs.conversations.axolotl"><device
+           id="259621345"/><device
+           id="584672103"/></list></item></items></event></message>
+
+    Returns the sender jid and the list of integer device ids, the sender
+    is None if the stanza could not be parsed.
+    """
+    xml = ET.fromstring(stanza)
+
+    try:
+        sender_jid = xml.attrib.get('from')
+    except AttributeError:
+        sender_jid = None
+
+    if sender_jid is None:
+        event_node = xml.find('./{%s}event' % NS_PUBSUB_EVENT)
+        try:
+            sender_jid = event_node.attrib.get('from')
+        except AttributeError:
+            logger.error('Could not find Sender in stanza: {0}'.format(stanza))
+            return None, []
+
+    item_list = xml.find('.//{%s}list' % NS_OMEMO)
+    if item_list is None or len(item_list) <= 0:
+        logger.error('pubsub node not found.')
+        logger.error(stanza)
+        return None, []
+
+    device_ids = [int(d.attrib['id']) for d in list(item_list)]
+
+    return sender_jid, device_ids
+
+
+def bundle_announcement(from_jid, device_id, bundle):
+    """ announce bundle info
+
+    """
+    # TODO: move it to wrap/unwrap methods
+    announce_template = ('<iq from="{from_jid}" type="set" id="{req_id}">'
+                         '<pubsub xmlns="http://jabber.org/protocol/pubsub">'
+                         '<publish node="{bundles_ns}:{device_id}">'
+                         '<item>'
+                         '<bundle xmlns="{omemo_ns}">'
+                         '</bundle>'
+                         '</item>'
+                         '</publish>'
+                         '</pubsub>'
+                         '</iq>')
+
+    bundle_msg = announce_template.format(from_jid=from_jid,
+                                          req_id=str(uuid.uuid4()),
+                                          device_id=device_id,
+                                          bundles_ns=NS_BUNDLES,
+                                          omemo_ns=NS_OMEMO)
+
+    bundle_xml = ET.fromstring(bundle_msg)
+
+    # to be appended to announce_template
+    find_str = './/{%s}bundle' % NS_OMEMO
+    bundle_node = bundle_xml.find(find_str)
+    pre_key_signed_node = ET.SubElement(bundle_node, 'signedPreKeyPublic',
+                                        attrib={'signedPreKeyId': str(bundle['signedPreKeyId'])})
+    pre_key_signed_node.text = bundle.get('signedPreKeyPublic')
+
+    signedPreKeySignature_node = ET.SubElement(bundle_node,
+                                               'signedPreKeySignature')
+    signedPreKeySignature_node.text = bundle.get('signedPreKeySignature')
+
+    identityKey_node = ET.SubElement(bundle_node, 'identityKey')
+    identityKey_node.text = bundle.get('identityKey')
+
+    prekeys_node = ET.SubElement(bundle_node, 'prekeys')
+    for key_id, key in bundle.get('prekeys',[]):
+        key_node = ET.SubElement(prekeys_node, 'preKeyPublic',
+                                 attrib={'preKeyId': str(key_id)})
+        key_node.text = key
+
+    # reconvert xml to stanza
+    return ET.tostring(bundle_xml, encoding='utf8', method='xml')
+
+
+def bundle_requests(from_jid, recipient, device_ids):
+    """ Return one bundle request stanza per device of recipient. """
+    stanzas = []
+    for device_id in device_ids:
+        bundle_req_root = ET.Element('iq')
+        bundle_req_root.set('type', 'get')
+        bundle_req_root.set('from', from_jid)
+        bundle_req_root.set('to', recipient)
+        bundle_req_root.set('id', str(uuid.uuid4()))
+        pubsub_node = ET.SubElement(bundle_req_root, 'pubsub')
+        pubsub_node.set('xmlns', NS_PUBSUB)
+        items_node = ET.SubElement(pubsub_node, 'items')
+        items_node.set('node', '{0}:{1}'.format(NS_BUNDLES, device_id))
+
+        stanzas.append(ET.tostring(bundle_req_root, encoding='utf8',
+                                   method='xml'))
+
+    return stanzas
+
+
+def devicelist_announcement(from_jid, device_ids):
+
+    QUERY_MSG = ('<iq type="set" from="{from}" id="{id}">'
+                 '<pubsub xmlns="http://jabber.org/protocol/pubsub">'
+                 '<publish node="{devicelist_ns}">'
+                 '<item id="1">'
+                 '<list xmlns="{omemo_ns}">'
+                 '{devices}'
+                 '</list>'
+                 '</item>'
+                 '</publish>'
+                 '</pubsub>'
+                 '</iq>')
+
+    device_nodes = ['<device id="{0}"/>'.format(d) for d in device_ids]
+
+    msg_dict = {'from': from_jid,
+                'devices': ''.join(device_nodes),
+                'id': str(uuid.uuid4()),
+                'omemo_ns': NS_OMEMO,
+                'devicelist_ns': NS_DEVICE_LIST}
+
+    return QUERY_MSG.format(**msg_dict)
+
+
+def devicelist_query(from_jid, contact_jid):
+
+    QUERY_MSG = ('<iq type="get" from="{from}" to="{to}" id="{id}">'
+                 '<pubsub xmlns="http://jabber.org/protocol/pubsub">'
+                 '<items node="{device_list_ns}" />'
+                 '</pubsub>'
+                 '</iq>')
+
+    msg_dict = {'from': from_jid,
+                'to': contact_jid,
+                'id': str(uuid.uuid4()),
+                'device_list_ns': NS_DEVICE_LIST}
+
+    return QUERY_MSG.format(**msg_dict)
+
+
+def message_body(stanza):
+    """ Return the bare recipient jid and the body of a message stanza. """
+    msg_xml = ET.fromstring(stanza)
+    jid = msg_xml.attrib['to']
+    raw_jid = jid.rsplit('/', 1)[0]
+
+    body_node = msg_xml.find('.//body')
+
+    return raw_jid, body_node.text
+
+
+def encrypted_message(from_jid, to_jid, msg_dict):
+    """ Build the message stanza of a msg_dict as returned by create_msg. """
+
+    OMEMO_MSG = ('<message to="{to}" from="{from}" id="{id}" type="chat">'
+                 '<encrypted xmlns="{omemo_ns}">'
+                 '<header sid="{sid}">'
+                 '{keys}'
+                 '<iv>{iv}</iv>'
+                 '</header>'
+                 '<payload>{enc_body}</payload>'
+                 '</encrypted>'
+                 '<store xmlns="urn:xmpp:hints"/>'
+                 '</message>')
+
+    # build encrypted message from here
+    keys_dict = msg_dict['keys']
+    keys_str = ''.join(
+        ['<key rid="{0}">{1}</key>'.format(rid, key) for rid, key in
+         keys_dict.items()])
+
+    msg_dict = {'to': to_jid,
+                'from': from_jid,
+                'id': str(uuid.uuid4()),
+                'omemo_ns': NS_OMEMO,
+                'sid': msg_dict['sid'],
+                'keys': keys_str,
+                'iv': msg_dict['iv'],
+                'enc_body': msg_dict['payload']}
+
+    return OMEMO_MSG.format(**msg_dict)
+
+
+def disco_query(from_jid, to_jid, req_id, ns):
+    """ Build a disco#items or disco#info query, depending on ns. """
+    return ('<iq type="get" from="{from}" to="{to}" id="{id}">'
+            '<query xmlns="{ns}"/>'
+            '</iq>').format(**{'from': from_jid,
+                               'to': to_jid,
+                               'id': req_id,
+                               'ns': ns})
+
+
+def disco_item_jids(xml):
+    """ Return the jids of a disco#items result, including its sender. """
+    # the server itself may offer services as well
+    jids = [xml.attrib.get('from')]
+    jids += [item.attrib.get('jid') for item in
+             xml.iter('{%s}item' % NS_DISCO_ITEMS)]
+
+    return [jid for jid in jids if jid]
+
+
+def has_disco_feature(xml, feature):
+    return any(node.attrib.get('var') == feature
+               for node in xml.iter('{%s}feature' % NS_DISCO_INFO))
+
+
+def upload_slot_request(from_jid, service, req_id, filename, size):
+    slot_req = ET.Element('iq')
+    slot_req.set('type', 'get')
+    slot_req.set('from', from_jid)
+    slot_req.set('to', service)
+    slot_req.set('id', req_id)
+    request_node = ET.SubElement(slot_req, 'request')
+    request_node.set('xmlns', NS_HTTP_UPLOAD)
+    request_node.set('filename', filename)
+    request_node.set('size', str(size))
+    request_node.set('content-type', 'application/octet-stream')
+
+    return ET.tostring(slot_req, encoding='utf8', method='xml')
+
+
+def parse_upload_slot(xml):
+    """ Return put url, get url and the allowed put headers of a slot. """
+    put_node = xml.find('.//{%s}put' % NS_HTTP_UPLOAD)
+    get_node = xml.find('.//{%s}get' % NS_HTTP_UPLOAD)
+    headers = dict((h.attrib['name'], (h.text or '').strip())
+                   for h in put_node.findall('{%s}header' % NS_HTTP_UPLOAD)
+                   if h.attrib.get('name') in ('Authorization', 'Cookie',
+                                               'Expires'))
+
+    return put_node.attrib['url'], get_node.attrib['url'], headers
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+""" Per-account OMEMO state: db, OmemoState, identity and device caches. """
+import logging
+import os
+import sqlite3
+from array import array
+
+from prof_omemo.constants import (DEVICE_ACTIVE, DEVICE_ID_TYPECODE,
+                                  DEVICE_TRUSTED, TRUST_ACCEPTED,
+                                  TRUST_CHANGED, TRUST_UNDECIDED)
+
+logger = logging.getLogger(__name__)
+
+HOME = os.path.expanduser("~")
+XDG_DATA_HOME = os.environ.get("XDG_DATA_HOME",
+                               os.path.join(HOME, ".local", "share"))
+
+
+def db(account_name):
+    """ Open the sqlite db of the given account. """
+    db_path = get_db_path(account_name)
+    db_root = os.path.dirname(db_path)
+    if not os.path.isdir(db_root):
+        os.makedirs(db_root)
+    logger.info('Using database path {}'.format(db_path))
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    return conn
+
+
+def get_local_data_path(account_name):
+    safe_username = account_name.replace('@', '_at_')
+
+    return os.path.join(XDG_DATA_HOME, 'profanity', 'omemo', safe_username)
+
+
+def get_db_path(account_name):
+    return os.path.join(get_local_data_path(account_name), 'omemo.db')
+
+
+class OmemoContext(object):
+    """ Holds everything OMEMO related for a single account.
+
+    The context owns the accounts db connection, its OmemoState, the cached
+    bundle and device lists as well as the counters for pending requests.
+    Contexts are kept in a ContextRegistry keyed by account name, so
+    reconnecting or switching accounts reuses the already opened db and
+    state.
+    """
+
+    def __init__(self, account_name, fulljid):
+        # loading the omemo library pulls in axolotl and its crypto deps
+        from omemo.state import OmemoState
+
+        self.account = account_name
+        self.fulljid = fulljid
+        self.db = db(account_name)
+        self.state = OmemoState(self.db)
+        self.bundle = self.state.bundle
+        self.identities = IdentityCache(self.db)
+        self.devices = DeviceRegistry(self.state, self.identities)
+        # the library looks up the recipient devices itself when encrypting,
+        # let it ask the registry like the rest of the plugin does
+        self.state.device_list_for = self._device_list_for
+        # jids already offered by the /omemo completers
+        self.completer_jids = set()
+        self.req_incr = {}
+        # request id -> callback(context, xml) for pending iq requests
+        self.pending = {}
+        # request id -> encrypted file waiting for its upload slot
+        self.uploads = {}
+        self.upload_service = None
+
+    @property
+    def barejid(self):
+        return self.fulljid.rsplit('/', 1)[0]
+
+    @property
+    def own_device_id(self):
+        return self.state.own_device_id
+
+    def _device_list_for(self, jid):
+        """ Return the active devices of jid, our own one left out. """
+        devices = set(self.devices.devices(jid))
+        if jid == self.barejid:
+            devices.discard(self.own_device_id)
+        return devices
+
+    def request_id(self, req_type):
+        """ Return the next request id for the given request type. """
+        req_id = self.req_incr.get(req_type, 0) + 1
+        self.req_incr[req_type] = req_id
+
+        return '{0}{1}'.format(req_type, req_id)
+
+    def has_session(self, jid, device_id):
+        store = getattr(self.state, 'store', None)
+        if store is None:
+            return False
+        return store.containsSession(jid, device_id)
+
+    def build_session(self, jid, device_id, bundle_info):
+        """ Build a session from a bundle unless it was verified before.
+
+        Returns a tuple (built, identity_changed). Bundles repeating the
+        verified identity of a device with an existing session are skipped,
+        otherwise the omemo library verifies the signed prekey signature.
+        Devices seen for the first time are undecided, only trust_device
+        makes them trusted.
+        """
+        identity = (bundle_info['identityKey'], bundle_info['signedPreKeyId'],
+                    bundle_info['signedPreKeySignature'])
+        cached = self.identities.lookup(jid, device_id)
+        trust = TRUST_UNDECIDED
+        identity_changed = False
+
+        if cached is not None:
+            if cached[:3] == identity and self.has_session(jid, device_id):
+                # the session was already built from this very bundle
+                logger.info('Bundle of {0}:{1} already verified.'.format(
+                    jid, device_id))
+                return False, False
+
+            if cached[0] != identity[0]:
+                logger.warning('Identity key of {0}:{1} changed.'.format(
+                    jid, device_id))
+                trust = TRUST_CHANGED
+                identity_changed = True
+            else:
+                trust = cached[3]
+
+        # verifies the signed prekey signature against the identity key
+        self.state.build_session(jid, device_id, bundle_info)
+        self.identities.store(jid, device_id, identity[0], identity[1],
+                              identity[2], trust)
+        if identity_changed:
+            self.devices.set_trusted(jid, device_id, False)
+
+        return True, identity_changed
+
+    def trust_device(self, jid, device_id):
+        """ Accept the current identity key of a device as trusted.
+
+        Returns False if no bundle of the device was verified yet.
+        """
+        if not self.identities.set_trust(jid, device_id, TRUST_ACCEPTED):
+            return False
+
+        self.devices.set_trusted(jid, device_id, True)
+        return True
+
+
+class IdentityCache(object):
+    """ Persistent cache of bundle signatures that were already verified.
+
+    Maps (jid, device id) to the (identityKey, signedPreKeyId,
+    signedPreKeySignature) triple of the last bundle a session was built
+    from, together with its trust state. The table lives in the accounts db
+    and is loaded into memory once.
+
+    A verified signature only proves the bundle belongs to the identity
+    key, so new identities start out undecided and are trusted once the
+    user accepts them. The trust state is informational: sessions are built
+    and used for undecided devices and devices with a changed identity key
+    as well, they are just not shown as trusted.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._conn.execute('CREATE TABLE IF NOT EXISTS verified_identities ('
+                           'jid TEXT, device_id INTEGER, identity_key TEXT, '
+                           'signed_pre_key_id INTEGER, signature TEXT, '
+                           'trust INTEGER, PRIMARY KEY (jid, device_id))')
+        self._conn.commit()
+
+        self._identities = {}
+        for row in self._conn.execute('SELECT jid, device_id, identity_key, '
+                                      'signed_pre_key_id, signature, trust '
+                                      'FROM verified_identities'):
+            self._identities[(row[0], row[1])] = tuple(row[2:])
+
+    def lookup(self, jid, device_id):
+        """ Return (identity_key, signed_pre_key_id, signature, trust) or None. """
+        return self._identities.get((jid, device_id))
+
+    def store(self, jid, device_id, identity_key, signed_pre_key_id,
+              signature, trust):
+        self._identities[(jid, device_id)] = (identity_key, signed_pre_key_id,
+                                              signature, trust)
+        self._conn.execute('INSERT OR REPLACE INTO verified_identities '
+                           'VALUES (?, ?, ?, ?, ?, ?)',
+                           (jid, device_id, identity_key, signed_pre_key_id,
+                            signature, trust))
+        self._conn.commit()
+
+    def set_trust(self, jid, device_id, trust):
+        """ Change the trust state of a known identity.
+
+        Returns False if no identity of the device was verified yet.
+        """
+        identity = self._identities.get((jid, device_id))
+        if identity is None:
+            return False
+
+        self.store(jid, device_id, identity[0], identity[1], identity[2],
+                   trust)
+        return True
+
+
+class _DeviceRecord(object):
+    """ Device ids of a single jid and their DEVICE_* flags. """
+
+    __slots__ = ('ids', 'flags')
+
+    def __init__(self):
+        self.ids = array(DEVICE_ID_TYPECODE)
+        self.flags = array('B')
+
+
+class DeviceRegistry(object):
+    """ In-memory registry of the devices of every known jid.
+
+    Device ids are kept as integers in compact arrays, one record per jid.
+    The device list of a jid is loaded from the OmemoState once on first
+    use and afterwards updated incrementally. Devices that vanish from a
+    device list are kept as inactive, so their trust is not lost.
+    """
+
+    def __init__(self, state, identities):
+        self._state = state
+        # the OmemoState lookup is replaced by one served from the registry
+        self._load_device_list = state.device_list_for
+        self._identities = identities
+        self._records = {}
+
+    def _record(self, jid):
+        record = self._records.get(jid)
+        if record is None:
+            record = _DeviceRecord()
+            for device_id in self._load_device_list(jid) or []:
+                self._add(jid, record, int(device_id), DEVICE_ACTIVE)
+            self._records[jid] = record
+        return record
+
+    def _add(self, jid, record, device_id, flags):
+        identity = self._identities.lookup(jid, device_id)
+        if identity is not None and identity[3] == TRUST_ACCEPTED:
+            flags |= DEVICE_TRUSTED
+        record.ids.append(device_id)
+        record.flags.append(flags)
+
+    def devices(self, jid, flag=DEVICE_ACTIVE):
+        """ Return the ids of all devices of jid having flag set. """
+        record = self._record(jid)
+        return [device_id for device_id, flags in zip(record.ids, record.flags)
+                if flags & flag == flag]
+
+    def flags(self, jid):
+        """ Return a list of (device id, flags) tuples of jid. """
+        record = self._record(jid)
+        return list(zip(record.ids, record.flags))
+
+    def update(self, jid, device_ids):
+        """ Replace the active devices of jid with device_ids. """
+        record = self._record(jid)
+        active = set(device_ids)
+
+        for i, device_id in enumerate(record.ids):
+            if device_id in active:
+                record.flags[i] |= DEVICE_ACTIVE
+                active.discard(device_id)
+            else:
+                record.flags[i] &= ~DEVICE_ACTIVE & 0xFF
+
+        for device_id in device_ids:
+            if device_id in active:
+                self._add(jid, record, device_id, DEVICE_ACTIVE)
+                active.discard(device_id)
+
+        self._state.add_devices(jid, list(device_ids))
+
+    def set_trusted(self, jid, device_id, trusted):
+        record = self._record(jid)
+        for i, known_id in enumerate(record.ids):
+            if known_id == device_id:
+                if trusted:
+                    record.flags[i] |= DEVICE_TRUSTED
+                else:
+                    record.flags[i] &= ~DEVICE_TRUSTED & 0xFF
+                return
+
+
+class ContextRegistry(object):
+    """ All OmemoContexts by account name and the currently active one. """
+
+    def __init__(self):
+        self._contexts = {}
+        self.current_account = None
+
+    def get(self, account_name, fulljid):
+        """ Return the context of account_name, creating it on first use. """
+        context = self._contexts.get(account_name)
+        if context is None:
+            logger.info('Creating OMEMO context for {0}.'.format(account_name))
+            context = OmemoContext(account_name, fulljid)
+            self._contexts[account_name] = context
+        else:
+            logger.info('Reusing OMEMO context for {0}.'.format(account_name))
+            # the resource may have changed since the last connect
+            context.fulljid = fulljid
+
+        return context
+
+    @property
+    def current(self):
+        """ The context of the currently connected account or None. """
+        return self._contexts.get(self.current_account)
+
+    def for_stanza(self, xml, outgoing=False):
+        """ Select the context the given stanza belongs to.
+
+        Incoming stanzas are matched by the account they are addressed to,
+        outgoing stanzas by the account they are sent from. The recipient of
+        an outgoing stanza may be another of our accounts, so it is never
+        used. Falls back to the current account.
+        """
+        jid = xml.attrib.get('from' if outgoing else 'to')
+        if jid:
+            barejid = jid.rsplit('/', 1)[0]
+            for context in self._contexts.values():
+                if context.barejid == barejid:
+                    return context
+
+        return self.current
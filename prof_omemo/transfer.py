@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+""" Streaming HTTP upload and download of aesgcm:// encrypted files. """
+import logging
+import os
+import tempfile
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection
+    from urllib.parse import urlparse
+except ImportError:
+    # python 2
+    from httplib import HTTPConnection, HTTPSConnection
+    from urlparse import urlparse
+
+from prof_omemo.constants import AESGCM_TAG_SIZE, FILE_CHUNK_SIZE, HTTP_TIMEOUT
+from prof_omemo.crypto import decrypt_file, parse_aesgcm_url
+from prof_omemo.errors import DownloadTooLarge
+
+logger = logging.getLogger(__name__)
+
+
+def _http_connection(url):
+    conn_cls = HTTPSConnection if url.scheme == 'https' else HTTPConnection
+    return conn_cls(url.netloc, timeout=HTTP_TIMEOUT)
+
+
+class _LimitedReader(object):
+    """ File like wrapper raising DownloadTooLarge past limit bytes. """
+
+    def __init__(self, fileobj, limit):
+        self._fileobj = fileobj
+        self._remaining = limit
+
+    def read(self, size):
+        data = self._fileobj.read(size)
+        self._remaining -= len(data)
+        if self._remaining < 0:
+            raise DownloadTooLarge()
+        return data
+
+
+class _EncryptingReader(object):
+    """ File like wrapper encrypting the first size bytes of src as read.
+
+    The authentication tag follows the ciphertext, so size + AESGCM_TAG_SIZE
+    bytes are read in total. Raises IOError if src ends early.
+    """
+
+    def __init__(self, backend, src, size, key, iv):
+        self._src = src
+        self._remaining = size
+        self._encryptor = backend.encryptor(key, iv)
+        self._buffer = b''
+        self._finished = False
+
+    def _fill(self):
+        chunk = self._src.read(min(FILE_CHUNK_SIZE, self._remaining))
+        if self._remaining and not chunk:
+            raise IOError('File shrank while uploading')
+        self._remaining -= len(chunk)
+        self._buffer += self._encryptor.update(chunk)
+        if not self._remaining:
+            self._buffer += self._encryptor.finalize() + self._encryptor.tag
+            self._finished = True
+
+    def read(self, size=-1):
+        while not self._finished and (size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def http_put(put_url, fileobj, size, headers):
+    """ Stream fileobj to put_url, returns the http status code. """
+    url = urlparse(put_url)
+    headers = dict(headers)
+    headers['Content-Length'] = str(size)
+    headers['Content-Type'] = 'application/octet-stream'
+
+    conn = _http_connection(url)
+    try:
+        # httplib reads file like bodies in blocks instead of loading them
+        conn.request('PUT', url.path + ('?' + url.query if url.query else ''),
+                     fileobj, headers)
+        return conn.getresponse().status
+    finally:
+        conn.close()
+
+
+def upload_file(backend, put_url, headers, path, size, key, iv):
+    """ Encrypt the first size bytes of the file at path into a streamed PUT.
+
+    The ciphertext is produced while the body is sent, no encrypted copy of
+    the file is written anywhere. Returns the http status code.
+    """
+    with open(path, 'rb') as src:
+        body = _EncryptingReader(backend, src, size, key, iv)
+        return http_put(put_url, body, size + AESGCM_TAG_SIZE, headers)
+
+
+def download_file(backend, aesgcm_url, download_dir, max_size=None):
+    """ Download and decrypt an aesgcm:// link, returns the local file path. """
+    https_url, key, iv = parse_aesgcm_url(aesgcm_url)
+    return download_decrypted(backend, https_url, key, iv, download_dir,
+                              max_size)
+
+
+def download_decrypted(backend, get_url, key, iv, download_dir,
+                       max_size=None):
+    """ Download get_url into download_dir, decrypting it with key and iv.
+
+    The download is decrypted while streaming, it is never held in memory.
+    Raises DownloadTooLarge for files larger than max_size bytes if
+    max_size is given. Returns the local file path.
+    """
+    url = urlparse(get_url)
+
+    if not os.path.isdir(download_dir):
+        os.makedirs(download_dir)
+
+    filename = os.path.basename(url.path) or 'download'
+    fd, file_path = tempfile.mkstemp(prefix='', suffix='-' + filename,
+                                     dir=download_dir)
+
+    path = url.path + ('?' + url.query if url.query else '')
+    conn = _http_connection(url)
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            conn.request('GET', path)
+            response = conn.getresponse()
+            if response.status != 200:
+                raise IOError('Download failed with HTTP status {0}'.format(
+                    response.status))
+
+            src = response
+            if max_size is not None:
+                limit = max_size + AESGCM_TAG_SIZE
+                length = response.getheader('Content-Length')
+                if length is not None and int(length) > limit:
+                    raise DownloadTooLarge()
+                src = _LimitedReader(response, limit)
+
+            decrypt_file(backend, src, dst, key, iv)
+    except Exception:
+        os.remove(file_path)
+        raise
+    finally:
+        conn.close()
+
+    logger.info('Downloaded {0} to {1}.'.format(get_url, file_path))
+    return file_path
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+""" Tests of the prof_omemo core, run without profanity or the omemo library.
+
+    python -m pytest tests
+"""
+import io
+import os
+import sqlite3
+import unittest
+
+from prof_omemo import crypto
+from prof_omemo.constants import (DEVICE_ACTIVE, DEVICE_TRUSTED,
+                                  TRUST_ACCEPTED, TRUST_CHANGED,
+                                  TRUST_UNDECIDED)
+from prof_omemo.errors import InvalidPayloadTag
+from prof_omemo.stanza import ET
+from prof_omemo.state import (ContextRegistry, DeviceRegistry, IdentityCache,
+                              OmemoContext)
+
+try:
+    crypto.CryptographyBackend()
+    HAVE_CRYPTOGRAPHY = True
+except ImportError:
+    HAVE_CRYPTOGRAPHY = False
+
+
+class FakeStore(object):
+
+    def __init__(self):
+        self.sessions = set()
+
+    def containsSession(self, jid, device_id):
+        return (jid, device_id) in self.sessions
+
+
+class FakeOmemoState(object):
+    """ The parts of OmemoState the core uses. """
+
+    def __init__(self, device_lists=None):
+        self.own_device_id = 1
+        self.store = FakeStore()
+        self.device_lists = dict(device_lists or {})
+        self.built = []
+
+    def device_list_for(self, jid):
+        return self.device_lists.get(jid, [])
+
+    def add_devices(self, jid, device_ids):
+        self.device_lists[jid] = device_ids
+
+    def build_session(self, jid, device_id, bundle_info):
+        self.built.append((jid, device_id))
+        self.store.sessions.add((jid, device_id))
+
+
+def _bundle(identity_key='identity'):
+    return {'identityKey': identity_key,
+            'signedPreKeyId': 1,
+            'signedPreKeySignature': 'signature'}
+
+
+def _context(state):
+    """ Return an OmemoContext on state without opening an account db. """
+    context = OmemoContext.__new__(OmemoContext)
+    context.state = state
+    context.identities = IdentityCache(sqlite3.connect(':memory:'))
+    context.devices = DeviceRegistry(state, context.identities)
+    return context
+
+
+class PythonBackendTest(unittest.TestCase):
+
+    @unittest.skipUnless(HAVE_CRYPTOGRAPHY, 'cryptography is not installed')
+    def test_matches_cryptography(self):
+        python, native = crypto.PythonBackend(), crypto.CryptographyBackend()
+        for iv_size in (12, 16):
+            for length in (0, 1, 15, 17, 33, 100):
+                key, iv = os.urandom(16), os.urandom(iv_size)
+                plaintext = os.urandom(length)
+                expected = crypto.aes_gcm_encrypt(native, key, iv, plaintext)
+                self.assertEqual(
+                    crypto.aes_gcm_encrypt(python, key, iv, plaintext),
+                    expected)
+                self.assertEqual(
+                    crypto.aes_gcm_decrypt(python, key, iv, expected),
+                    plaintext)
+
+    def test_rejects_tampered_tag(self):
+        backend = crypto.PythonBackend()
+        key, iv = os.urandom(16), os.urandom(12)
+        data = crypto.aes_gcm_encrypt(backend, key, iv, b'payload')
+        tampered = data[:-1] + (b'\x00' if data[-1:] != b'\x00' else b'\x01')
+        self.assertRaises(InvalidPayloadTag, crypto.aes_gcm_decrypt, backend,
+                          key, iv, tampered)
+
+
+class FileCryptoTest(unittest.TestCase):
+
+    def test_decrypt_with_chunks_smaller_than_tag(self):
+        backend = crypto.PythonBackend()
+        key, iv = os.urandom(32), os.urandom(12)
+        plaintext = os.urandom(100)
+        encrypted = io.BytesIO()
+        crypto.encrypt_file(backend, io.BytesIO(plaintext), encrypted, key, iv)
+
+        for chunk_size in (1, 5, 15, 16, 17):
+            decrypted = io.BytesIO()
+            crypto.decrypt_file(backend, io.BytesIO(encrypted.getvalue()),
+                                decrypted, key, iv, chunk_size=chunk_size)
+            self.assertEqual(decrypted.getvalue(), plaintext)
+
+
+class DeviceRegistryTest(unittest.TestCase):
+
+    def test_update_marks_dropped_devices_inactive(self):
+        state = FakeOmemoState({'bob@example.com': [2, 3]})
+        registry = DeviceRegistry(state, IdentityCache(
+            sqlite3.connect(':memory:')))
+
+        registry.update('bob@example.com', [3, 4])
+
+        self.assertEqual(registry.devices('bob@example.com'), [3, 4])
+        self.assertEqual(registry.flags('bob@example.com'),
+                         [(2, 0), (3, DEVICE_ACTIVE), (4, DEVICE_ACTIVE)])
+        self.assertEqual(state.device_lists['bob@example.com'], [3, 4])
+
+
+class BuildSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state = FakeOmemoState({'bob@example.com': [2]})
+        self.context = _context(self.state)
+
+    def test_new_device_is_undecided(self):
+        self.assertEqual(self.context.build_session('bob@example.com', 2,
+                                                    _bundle()),
+                         (True, False))
+        self.assertEqual(
+            self.context.identities.lookup('bob@example.com', 2)[3],
+            TRUST_UNDECIDED)
+        self.assertEqual(self.context.devices.flags('bob@example.com'),
+                         [(2, DEVICE_ACTIVE)])
+
+    def test_skips_known_bundle(self):
+        self.context.build_session('bob@example.com', 2, _bundle())
+
+        self.assertEqual(self.context.build_session('bob@example.com', 2,
+                                                     _bundle()),
+                         (False, False))
+        self.assertEqual(self.state.built, [('bob@example.com', 2)])
+
+    def test_identity_change(self):
+        self.context.build_session('bob@example.com', 2, _bundle())
+        self.context.trust_device('bob@example.com', 2)
+        self.assertEqual(self.context.devices.flags('bob@example.com'),
+                         [(2, DEVICE_ACTIVE | DEVICE_TRUSTED)])
+
+        self.assertEqual(self.context.build_session('bob@example.com', 2,
+                                                    _bundle('new identity')),
+                         (True, True))
+        self.assertEqual(
+            self.context.identities.lookup('bob@example.com', 2)[3],
+            TRUST_CHANGED)
+        self.assertEqual(self.context.devices.flags('bob@example.com'),
+                         [(2, DEVICE_ACTIVE)])
+
+        self.assertTrue(self.context.trust_device('bob@example.com', 2))
+        self.assertEqual(
+            self.context.identities.lookup('bob@example.com', 2)[3],
+            TRUST_ACCEPTED)
+
+
+class FakeContext(object):
+
+    def __init__(self, barejid):
+        self.barejid = barejid
+
+
+class ContextRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = ContextRegistry()
+        self.alice = FakeContext('alice@example.com')
+        self.bob = FakeContext('bob@example.com')
+        self.registry._contexts = {'alice': self.alice, 'bob': self.bob}
+        self.registry.current_account = 'alice'
+
+    def test_incoming_stanza_uses_to(self):
+        xml = ET.fromstring('<message from="alice@example.com/a" '
+                            'to="bob@example.com/b"/>')
+        self.assertIs(self.registry.for_stanza(xml), self.bob)
+
+    def test_outgoing_stanza_uses_from(self):
+        xml = ET.fromstring('<message from="bob@example.com/b" '
+                            'to="alice@example.com"/>')
+        self.assertIs(self.registry.for_stanza(xml, outgoing=True), self.bob)
+
+    def test_falls_back_to_current_account(self):
+        xml = ET.fromstring('<message to="carol@example.com"/>')
+        self.assertIs(self.registry.for_stanza(xml, outgoing=True),
+                      self.alice)
+        self.assertIs(self.registry.for_stanza(xml), self.alice)
+
+
+if __name__ == '__main__':
+    unittest.main()